@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 import os
-import numpy as np
+import io
+import re
+import functools
+import hashlib
+import pathlib
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
 import html
-from bs4 import BeautifulSoup
 
-import bibtexparser
 from bibtexparser.bparser import BibTexParser
-from bibtexparser.customization import convert_to_unicode
-import eyed3
+from pylatexenc.latex2text import LatexNodes2Text
+from mutagen.id3 import ID3, TPE1, TIT2, TALB, TPE2
 
 from tokenizer import MyTokenizer
 
@@ -19,7 +26,103 @@ acronyms = [
     'MYNN',
 ]
 
-spelled_out_form = ['-'.join(list(acronym)) for acronym in acronyms]
+# precompiled helpers for _clean_text -- a real LaTeX-to-text converter
+# (which handles \emph, accents, math, ... that the old brace/dollar
+# stripping missed) plus a single-pass acronym expansion
+_latex2text = LatexNodes2Text(math_mode='text', strict_latex_spaces=False)
+_acronym_re = re.compile(r'\b(' + '|'.join(acronyms) + r')\b')
+
+# bib fields only ever contain simple tags like <i> or <sub>, so a tiny
+# regex strips them without building a DOM per field
+_tag_re = re.compile(r'<[^>]+>')
+
+
+@functools.lru_cache(maxsize=4096)
+def _clean_text(s):
+    """Convert a bib field to plain speakable text
+
+    Memoized since the same strings (journal names, keyword lists) recur
+    across many entries in a typical bibliography.
+    """
+    s = _latex2text.latex_to_text(s)
+    # get rid of HTML entities/tags, only if markup is present
+    if '<' in s or '&' in s:
+        s = _tag_re.sub('', html.unescape(s))
+    # spell out common acronyms in a single pass
+    s = _acronym_re.sub(lambda m: '-'.join(m.group(1)), s)
+    return s
+
+# attributes written to / restored from the on-disk cache
+_cached_attrs = ('lib','keys','entries')
+
+# serialize console output from worker threads
+_print_lock = threading.Lock()
+
+
+@dataclass(slots=True)
+class Entry:
+    """Processed fields for a single article
+
+    Keeping all fields of an entry together means generating a
+    description is a handful of attribute reads on one object, rather
+    than a hash lookup into a separate dict per field.
+    """
+    author: str
+    title: str
+    year: Optional[str] = None
+    date: Optional[str] = None
+    publication: Optional[str] = None
+    keywords: Optional[str] = None
+    abstract: Optional[str] = None
+    description: str = ''
+
+
+class LazyBibEntries(object):
+    """Dict-like access to bib entries, parsing each entry on demand
+
+    The bib file is scanned once for entry keys and byte offsets; the
+    text for a given key is only run through BibTexParser when that key
+    is first accessed, so converting a single entry does not pay for
+    parsing the whole file.
+    """
+    entry_re = re.compile(rb'^@\w+\{([^,\s]+)\s*,', re.M)
+
+    def __init__(self,bibfile):
+        with open(bibfile,'rb') as bib:
+            self.buf = bib.read()
+        matches = list(self.entry_re.finditer(self.buf))
+        self.offsets = {}
+        for i,m in enumerate(matches):
+            start = m.start()
+            if i+1 < len(matches):
+                end = matches[i+1].start()
+            else:
+                end = len(self.buf)
+            self.offsets[m.group(1).decode()] = (start,end)
+        self.cache = {}
+
+    def keys(self):
+        return list(self.offsets.keys())
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self,key):
+        return key in self.offsets
+
+    def __getitem__(self,key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        start,end = self.offsets[key]
+        parser = BibTexParser(common_strings=True)
+        entries = parser.parse(
+            self.buf[start:end].decode('utf-8',errors='replace')
+        ).entries
+        assert len(entries) == 1, 'failed to parse entry '+key
+        self.cache[key] = entries[0]
+        return entries[0]
 
 
 class BibtexLibrary(object):
@@ -27,179 +130,159 @@ class BibtexLibrary(object):
     def __init__(self,
                  bibfile,
                  mp3dir=os.path.join(os.environ['HOME'],
-                                     'Music','Article Abstracts')
+                                     'Music','Article Abstracts'),
+                 lazy=False,
+                 cache=True
                 ):
-        parser = BibTexParser(common_strings=True)
-        parser.customization = convert_to_unicode
         self.bibname = os.path.split(bibfile)[1]
-        with open(bibfile) as bib:
-            bibdata = bibtexparser.load(bib, parser=parser)
-        self.lib = bibdata.entries
         self.mp3dir = mp3dir
         os.makedirs(mp3dir,exist_ok=True)
-        self._process_bib_data()
+        self.lazy = lazy
+        if lazy:
+            # only index entry offsets now; individual entries are parsed
+            # and processed on demand by generate_descriptions()
+            self.lib = LazyBibEntries(bibfile)
+            self.keys = self.lib.keys()
+            assert len(self.keys) == len(set(self.keys)),\
+                    'article keys are not unique!'
+            self.entries = {}
+        else:
+            # check for a cached copy of the processed library, keyed on
+            # the bib file contents -- loading a pickle is much faster
+            # than re-running bibtexparser on an unchanged file
+            cachefile = None
+            if cache:
+                with open(bibfile,'rb') as bib:
+                    filehash = hashlib.blake2b(bib.read(),
+                                               digest_size=16).hexdigest()
+                cachedir = pathlib.Path.home() / '.cache' / 'bib2mp3'
+                cachefile = cachedir / '{:s}.pkl'.format(filehash)
+                if cachefile.is_file():
+                    with open(cachefile,'rb') as f:
+                        self.__dict__.update(pickle.load(f))
+                    return
+            # note: no convert_to_unicode customization here -- that runs
+            # the LaTeX converter over every field of every entry, but we
+            # only render a handful of fields, so _clean_text converts
+            # just those instead
+            parser = BibTexParser(common_strings=True)
+            # skip post-processing we don't need
+            parser.ignore_nonstandard_types = True
+            parser.homogenize_fields = False
+            # hand the parser one big string rather than a file object so
+            # it isn't decoding line by line
+            raw = pathlib.Path(bibfile).read_text(encoding='utf-8',
+                                                  errors='replace')
+            self.lib = parser.parse(raw).entries
+            self._process_bib_data()
+            if cachefile is not None:
+                cachefile.parent.mkdir(parents=True, exist_ok=True)
+                with open(cachefile,'wb') as f:
+                    pickle.dump({k: getattr(self,k) for k in _cached_attrs},
+                                f, pickle.HIGHEST_PROTOCOL)
 
     def _process_bib_data(self):
         self.keys = [article['ID'] for article in self.lib]
         assert len(self.keys) == len(set(self.keys)),\
                 'article keys are not unique!'
-        self._process_bib_authors()
-        self._process_bib_titles()
-        self._process_bib_dates()
-        self._process_bib_pubnames()
-        self._process_bib_keywords()
-        self._process_bib_abstracts()
-
-    def _clean_text(self,s):
-        s = s.replace('{','').replace('}','')
-        s = s.replace('~','')
-        s = s.replace('$\\','').replace('$','')
-        # get rid of HTML tags
-        s = BeautifulSoup(html.unescape(s),'html.parser').text
-        # spell out common acronyms
-        for acronym,spelledout in zip(acronyms,spelled_out_form):
-            s = s.replace(acronym,spelledout)
-        return s
-
-    def _process_bib_authors(self):
-        self.author = {}
-        for key,article in zip(self.keys,self.lib):
-            authorstr = self._clean_text(article['author'])
-            #print(key,authorstr)
-            authorlist = [
-                author.strip().replace('.','')
-                for author in authorstr.split(' and ')
-            ]
-            #print(key,authorlist)
-            authorlist_firstlast = []
-            for author in authorlist:
-                # if "lastname, first", split by comma and reverse
-                firstlast = [s.strip() for s in author.split(',')]
-                assert (len(firstlast) <= 2) # should be 2 or 1
-                firstlast = ' '.join(firstlast[::-1])
-                authorlist_firstlast.append(firstlast)
-            #print(key,authorlist_firstlast)
-            if len(authorlist_firstlast) == 1:
-                authorstr = authorlist_firstlast[0]
-            elif len(authorlist_firstlast) == 2:
-                authorstr = '{:s} and {:s}'.format(*authorlist_firstlast)
-            elif len(authorlist_firstlast) == 3:
-                authorstr = '{:s}, {:s}, and {:s}'.format(*authorlist_firstlast)
-            else:
-                authorstr = '{:s} et al'.format(authorlist_firstlast[0])
-            #print(key,authorstr)
-            self.author[key] = authorstr
-
-    def _process_bib_titles(self):
-        self.title = {}
-        for key,article in zip(self.keys,self.lib):
-            self.title[key] = self._clean_text(article['title'])
-
-    def _process_bib_dates(self):
-        self.year = {}
-        self.date = {}
-        for key,article in zip(self.keys,self.lib):
-            year = article.get('year',None)
-            if year is None:
-                self.date[key] = None
-            else:
-                self.year[key] = year
-                self.date[key] = year
-            month = article.get('month',None)
-            if month is not None:
-                self.date[key] = '{:s} {:s}'.format(month,year)
-        num_missing_dates = np.count_nonzero(
-            [(d is None) for _,d in self.date.items()]
-        )
-        if num_missing_dates > 0:
-            print('Note:',
-                  num_missing_dates,'/',len(self.lib),
-                  'articles are missing dates')
-
-    def _process_bib_pubnames(self):
-        self.publication = {}
-        for key,article in zip(self.keys,self.lib):
-            if article['ENTRYTYPE'] == 'article':
-                name = article['journal']
-            else:
-                name = article.get('booktitle',None)
-            if name is not None:
-                name = self._clean_text(name)
-            self.publication[key] = name
-        num_missing_pubnames = np.count_nonzero(
-            [(n is None) for _,n in self.publication.items()]
-        )
-        if num_missing_pubnames > 0:
-            print('Note:',
-                  num_missing_pubnames,'/',len(self.lib),
-                  'articles are missing publication names')
-
-
-    def _process_bib_keywords(self):
-        self.keywords = {}
-        for key,article in zip(self.keys,self.lib):
-            kw = article.get('keywords',None)
-            if kw is not None:
-                kw = self._clean_text(kw)
-            self.keywords[key] = kw
-        num_missing_keywords = np.count_nonzero(
-            [(kw is None) for _,kw in self.keywords.items()]
-        )
-        if num_missing_keywords > 0:
-            print('Note:',
-                  num_missing_keywords,'/',len(self.lib),
-                  'articles are missing keywords')
-
-    def _process_bib_abstracts(self):
-        self.abstract = {}
-        for key,article in zip(self.keys,self.lib):
-            ab = article.get('abstract',None)
-            if ab is not None:
-                ab = self._clean_text(ab)
-            self.abstract[key] = ab
-        num_missing_abstracts = np.count_nonzero(
-            [(ab is None) for _,ab in self.abstract.items()]
+        self.entries = {a['ID']: self._process_entry(a) for a in self.lib}
+        self._report_missing_fields()
+
+    def _process_entry(self,article):
+        """Extract and clean all fields used for a single article"""
+        return Entry(
+            author=self._extract_author(article),
+            title=self._extract_title(article),
+            year=article.get('year',None),
+            date=self._extract_date(article),
+            publication=self._extract_pubname(article),
+            keywords=self._extract_keywords(article),
+            abstract=self._extract_abstract(article),
         )
-        if num_missing_abstracts > 0:
-            print('Note:',
-                  num_missing_abstracts,'/',len(self.lib),
-                  'articles are missing abstracts')
-
-
-    def generate_descriptions(self):
-        self.description = {}
-        # minimal information: author, title
-        for key in self.keys:
-            if self.date[key]:
-                desc = 'In {:s}, '.format(self.date[key])
-            else:
-                desc = ''
-            desc += '{:s} published a paper entitled: {:s}.'.format(
-                    self.author[key], self.title[key])
-            if self.publication[key]:
-                desc += ' This was published in {:s}.'.format(self.publication[key])
-            if self.keywords[key]:
-                desc += ' Publication keywords include: '
-                kwlist = [kw.strip() for kw in self.keywords[key].split(',')]
-                if kwlist == 1:
-                    kwstr = kwlist[0]
-                elif kwlist == 2:
-                    kwstr = '{:s} and {:s}'.format(*kwlist)
-                else:
-                    kwlist[-1] = 'and '+kwlist[-1]
-                    kwstr = ', '.join(kwlist)
-                desc += kwstr + '.'
-            if self.abstract[key]:
-                desc += ' The abstract reads: ' + self.abstract[key]
-            else:
-                desc += ' There is no abstract available.'
-            desc += ' This concludes the summary of the work' \
-                    + ' by {:s}.'.format(self.author[key])
-            self.description[key] = desc
 
+    def _process_article(self,key):
+        """Process all fields of a single article on demand (lazy mode)"""
+        self.entries[key] = self._process_entry(self.lib[key])
 
-    def to_mp3(self,key=None,overwrite=False,language='en-GB',debug=False):
-        from gtts import gTTS
+    def _report_missing_fields(self):
+        for field,desc in (('date','dates'),
+                           ('publication','publication names'),
+                           ('keywords','keywords'),
+                           ('abstract','abstracts')):
+            num_missing = sum(
+                1 for e in self.entries.values()
+                if getattr(e,field) is None
+            )
+            if num_missing > 0:
+                print('Note:',
+                      num_missing,'/',len(self.entries),
+                      'articles are missing',desc)
+
+    def _extract_author(self,article):
+        authorstr = _clean_text(article['author'])
+        #print(key,authorstr)
+        # fast path: a single author already in "First Last" form needs
+        # no splitting or reordering
+        if ',' not in authorstr and ' and ' not in authorstr:
+            return authorstr.strip().replace('.','')
+        authorlist = [
+            author.strip().replace('.','')
+            for author in authorstr.split(' and ')
+        ]
+        #print(key,authorlist)
+        authorlist_firstlast = []
+        for author in authorlist:
+            # if "lastname, first", split by comma and reverse
+            firstlast = [s.strip() for s in author.split(',')]
+            assert (len(firstlast) <= 2) # should be 2 or 1
+            firstlast = ' '.join(firstlast[::-1])
+            authorlist_firstlast.append(firstlast)
+        #print(key,authorlist_firstlast)
+        if len(authorlist_firstlast) == 1:
+            authorstr = authorlist_firstlast[0]
+        elif len(authorlist_firstlast) == 2:
+            authorstr = '{:s} and {:s}'.format(*authorlist_firstlast)
+        elif len(authorlist_firstlast) == 3:
+            authorstr = '{:s}, {:s}, and {:s}'.format(*authorlist_firstlast)
+        else:
+            authorstr = '{:s} et al'.format(authorlist_firstlast[0])
+        #print(key,authorstr)
+        return authorstr
+
+    def _extract_title(self,article):
+        return _clean_text(article['title'])
+
+    def _extract_date(self,article):
+        year = article.get('year',None)
+        if year is None:
+            return None
+        month = article.get('month',None)
+        if month is not None:
+            return '{:s} {:s}'.format(month,year)
+        return year
+
+    def _extract_pubname(self,article):
+        if article['ENTRYTYPE'] == 'article':
+            name = article['journal']
+        else:
+            name = article.get('booktitle',None)
+        if name is not None:
+            name = _clean_text(name)
+        return name
+
+    def _extract_keywords(self,article):
+        kw = article.get('keywords',None)
+        if kw is not None:
+            kw = _clean_text(kw)
+        return kw
+
+    def _extract_abstract(self,article):
+        ab = article.get('abstract',None)
+        if ab is not None:
+            ab = _clean_text(ab)
+        return ab
+
+    def generate_descriptions(self,key=None):
         if key is None:
             keylist = self.keys
         elif isinstance(key,str):
@@ -207,41 +290,121 @@ class BibtexLibrary(object):
         else:
             assert isinstance(key,list)
             keylist = key
-        tokefunc = lambda text: MyTokenizer(text,debug=debug)
         for key in keylist:
-            mp3file = os.path.join(self.mp3dir,'{:s}.mp3'.format(key))
-            overwriting = False
-            if os.path.isfile(mp3file):
-                if overwrite:
-                    overwriting = True
-                else:
+            self._build_description(key)
+
+    def _build_description(self,key):
+        """Generate the spoken description of a single article"""
+        if self.lazy and key not in self.entries:
+            self._process_article(key)
+        entry = self.entries[key]
+        # minimal information: author, title -- collect the fragments
+        # and join once at the end rather than repeatedly concatenating
+        parts = []
+        if entry.date:
+            parts.append(f'In {entry.date}, ')
+        parts.append(f'{entry.author} published a paper entitled: '
+                     f'{entry.title}.')
+        if entry.publication:
+            parts.append(f' This was published in {entry.publication}.')
+        if entry.keywords:
+            kwlist = [kw.strip() for kw in entry.keywords.split(',')]
+            if len(kwlist) == 1:
+                kwstr = kwlist[0]
+            elif len(kwlist) == 2:
+                kwstr = f'{kwlist[0]} and {kwlist[1]}'
+            else:
+                kwlist[-1] = 'and '+kwlist[-1]
+                kwstr = ', '.join(kwlist)
+            parts.append(f' Publication keywords include: {kwstr}.')
+        if entry.abstract:
+            parts.append(f' The abstract reads: {entry.abstract}')
+        else:
+            parts.append(' There is no abstract available.')
+        parts.append(f' This concludes the summary of the work'
+                     f' by {entry.author}.')
+        desc = ''.join(parts)
+        entry.description = desc
+        return desc
+
+
+    def _synthesize_one(self,key,overwrite,language,debug):
+        from gtts import gTTS
+        mp3file = os.path.join(self.mp3dir,'{:s}.mp3'.format(key))
+        overwriting = False
+        if os.path.isfile(mp3file):
+            if overwrite:
+                overwriting = True
+            else:
+                with _print_lock:
                     print('File exists, skipping',key)
-                    continue
-            assert hasattr(self,'description'), \
-                    'Need to run generate_descriptions'
-            tts = gTTS(text=self.description[key], lang=language, slow=False,
-                       tokenizer_func=tokefunc)
+                return (key, False)
+        # only build the description once we know this file actually
+        # needs to be synthesized
+        entry = self.entries.get(key)
+        if entry is None or not entry.description:
+            self._build_description(key)
+            entry = self.entries[key]
+        tokefunc = lambda text: MyTokenizer(text,debug=debug)
+        tts = gTTS(text=entry.description, lang=language, slow=False,
+                   tokenizer_func=tokefunc)
+        with _print_lock:
             if overwriting:
                 print('Overwriting',mp3file)
             else:
                 print('Writing',mp3file)
-            tts.save(mp3file)
-            # add metadata
-            mp3 = eyed3.load(mp3file)
-            mp3.initTag()
-            mp3.tag.artist = self.author[key]
-            mp3.tag.title = self.title[key]
-            mp3.tag.album = self.bibname
-            mp3.tag.album_artist = 'bib2mp3.py'
-            mp3.tag.save()
-            if debug: print(key,':',self.description[key])
+        # synthesize into memory, add metadata to the buffer, then write
+        # the file once -- instead of save / re-open / re-tag / re-write
+        buf = io.BytesIO()
+        tts.write_to_fp(buf)
+        tag = ID3()
+        tag.add(TPE1(encoding=3, text=entry.author))
+        tag.add(TIT2(encoding=3, text=entry.title))
+        tag.add(TALB(encoding=3, text=self.bibname))
+        tag.add(TPE2(encoding=3, text='bib2mp3.py'))
+        tag.save(buf)
+        with open(mp3file,'wb') as f:
+            f.write(buf.getbuffer())
+        if debug:
+            with _print_lock:
+                print(key,':',entry.description)
+        return (key, True)
+
+    def to_mp3(self,key=None,overwrite=False,language='en-GB',debug=False,
+               max_workers=8):
+        if key is None:
+            keylist = self.keys
+        elif isinstance(key,str):
+            keylist = [key]
+        else:
+            assert isinstance(key,list)
+            keylist = key
+        # each synthesis blocks on a gTTS request to Google, so overlap
+        # the network round trips across a pool of threads
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            list(ex.map(
+                lambda k: self._synthesize_one(k,overwrite,language,debug),
+                keylist
+            ))
+
+
+def _process_one(bibfile):
+    """Convert a single bib file, for use as a multiprocessing task"""
+    bib = BibtexLibrary(bibfile)
+    bib.to_mp3()
 
 
 #==============================================================================
 if __name__ == '__main__':
     import sys
+    import multiprocessing as mp
     if len(sys.argv) <= 1:
-        sys.exit('Specify bib file')
-    bib = BibtexLibrary(sys.argv[1])
-    bib.generate_descriptions()
-    bib.to_mp3()
+        sys.exit('Specify bib file(s)')
+    if len(sys.argv) == 2:
+        _process_one(sys.argv[1])
+    else:
+        # process libraries in parallel, overlapping the parsing of one
+        # bib file with the synthesis of another
+        nproc = min(len(sys.argv)-1, os.cpu_count())
+        with mp.Pool(nproc) as pool:
+            pool.map(_process_one, sys.argv[1:])
@@ -1,46 +1,122 @@
-import numpy as np
+import re
 from gtts.tokenizer.core import Tokenizer
 from gtts.tokenizer import tokenizer_cases
-import nltk
+from nltk.tag import PerceptronTagger
+from nltk.tokenize import PunktTokenizer, TreebankWordTokenizer
 
 MAXCHARS = 100
 
+# reusable nltk tokenizer/tagger instances -- nltk.word_tokenize and
+# nltk.pos_tag_sents go through registry lookups on every call, so keep
+# our own instances instead; the ones that load models from nltk_data
+# are deferred to first use so importing this module stays cheap
+_word_tokenizer = TreebankWordTokenizer()
+_sent_tokenizer = None
+_tagger = None
+
+def _load_models():
+    global _sent_tokenizer, _tagger
+    if _tagger is None:
+        _sent_tokenizer = PunktTokenizer()
+        _tagger = PerceptronTagger()
 
-# helper functions:
 
-def consolidate(token_tags):
-    for i,tag in enumerate(token_tags):
-        if not isinstance(tag,tuple):
-            # consolidate tree into token/tag that inherits tag of last leaf
-            token_tags[i] = (' '.join([tup[0] for tup in list(tag)]), tag[-1][1])
+# helper functions:
 
 def reconstruct(token_tags):
-    tokenlist = []
+    # greedily pack words into tokens in a single forward pass, keeping a
+    # running character count instead of recomputing lengths per token
     tmp = list(token_tags)
-    if tmp[-1][0] == '.':
+    if len(tmp) > 0 and tmp[-1][0] == '.':
         tmp.pop(-1)
-    while len(tmp) > 0:
-        counts = [len(tup[0])+1 for tup in tmp]
-        N = np.count_nonzero(np.cumsum(counts) <= MAXCHARS)
-        newtoken = ' '.join([tup[0] for tup in tmp[:N]])
-        tokenlist.append(newtoken)
-        tmp = tmp[N:]
+    tokenlist = []
+    words = []
+    nchars = 0
+    for word,_ in tmp:
+        nchars_needed = len(word) + (1 if words else 0)
+        if words and (nchars + nchars_needed > MAXCHARS):
+            tokenlist.append(' '.join(words))
+            words = [word]
+            nchars = len(word)
+        else:
+            words.append(word)
+            nchars += nchars_needed
+    if words:
+        tokenlist.append(' '.join(words))
     return tokenlist
 
 
 # Setup chunker - the magic is here
+#
+# These rules used to be interpreted by nltk.RegexpParser:
+#
+#   NounWithPrepositionalPhrase:
+#       {(<DT>|<CD>)<JJ>*<NN.?>+<IN><DT>?<JJ.?>*<NN.?>+}
+#       {<IN>(<DT>|<CD>)?<JJ.?>*(<NN.?>+|<PRP.?>)}
+#   NounPhrase:
+#       {(<DT>|<CD>)*<JJ.?>*<NN.?>+}
+#   VerbPhrase:
+#       {<MD>?<RB.?>?<VB.?>+<RB.?>?<JJ.?>*}
+#       {<TO><RB.?>?<VB.?><RB.?>?<NN.?>+}
+#
+# but are now compiled once into a single regex over the tag sequence
+# (each tag terminated by '|'), so chunking a phrase is one scan of a
+# short string instead of one Python-level parser pass per rule. The
+# parser applied each rule over the whole sequence before trying the
+# next, so the translation needs a few adjustments to match:
+#  - negative lookaheads keep the second NounWithPrepositionalPhrase
+#    form and the leading determiners of a NounPhrase from consuming
+#    the start of a NounWithPrepositionalPhrase match further on
+#  - the trailing adjectives of a VerbPhrase must not steal adjectives
+#    that the (earlier) NounPhrase rule would claim, i.e. ones that
+#    lead up to a noun
+#  - the second VerbPhrase form is unreachable in the original (its
+#    nouns are always chunked by NounPhrase first), so it is omitted
+_noun_with_pp = (r'(?:DT\||CD\|)(?:JJ\|)*(?:NN[^|]?\|)+'
+                 r'IN\|(?:DT\|)?(?:JJ[^|]?\|)*(?:NN[^|]?\|)+')
+_chunk_rules = [
+    _noun_with_pp,
+    r'IN\|(?!' + _noun_with_pp + r')(?:DT\||CD\|)?(?:JJ[^|]?\|)*'
+        r'(?:(?:NN[^|]?\|)+|PRP[^|]?\|)',
+    r'(?:(?:DT\||CD\|)(?!' + _noun_with_pp + r'))*'
+        r'(?:JJ[^|]?\|)*(?:NN[^|]?\|)+',
+    r'(?:MD\|)?(?:RB[^|]?\|)?(?:VB[^|]?\|)+(?:RB[^|]?\|)?'
+        r'(?:(?:JJ[^|]?\|)+(?!JJ|NN))?',
+]
+_chunk_re = re.compile('|'.join('(?:{:s})'.format(r) for r in _chunk_rules))
 
-grammar = """
-NounWithPrepositionalPhrase:
-    {(<DT>|<CD>)<JJ>*<NN.?>+<IN><DT>?<JJ.?>*<NN.?>+}
-    {<IN>(<DT>|<CD>)?<JJ.?>*(<NN.?>+|<PRP.?>)}
-NounPhrase:
-    {(<DT>|<CD>)*<JJ.?>*<NN.?>+}
-VerbPhrase:
-    {<MD>?<RB.?>?<VB.?>+<RB.?>?<JJ.?>*}
-    {<TO><RB.?>?<VB.?><RB.?>?<NN.?>+}
-"""
-chunker = nltk.RegexpParser(grammar)
+def chunk(word_tags):
+    """Group tagged words into phrases that shouldn't be broken up
+
+    Returns a flat list of (words, tag) tuples in which each chunk
+    inherits the tag of its last word, matching what RegexpParser.parse
+    followed by tree consolidation used to produce.
+    """
+    tagstr = ''.join(tag+'|' for _,tag in word_tags)
+    # character offset of each tag within tagstr
+    offset = []
+    pos = 0
+    for _,tag in word_tags:
+        offset.append(pos)
+        pos += len(tag)+1
+    offset.append(pos)
+    end_to_idx = {p:i for i,p in enumerate(offset)}
+    chunked = []
+    i = 0
+    while i < len(word_tags):
+        m = _chunk_re.match(tagstr, offset[i])
+        if m:
+            # matches always end on a tag boundary
+            j = end_to_idx[m.end()]
+            chunked.append((
+                ' '.join(w for w,_ in word_tags[i:j]),
+                word_tags[j-1][1]
+            ))
+            i = j
+        else:
+            chunked.append(word_tags[i])
+            i += 1
+    return chunked
 
 
 # tokenizers
@@ -58,6 +134,23 @@ def default_tokenizer(text):
 def MyTokenizer(text,debug=False):
     # first, use the default gTTS tokenizer
     default_tokens = default_tokenizer(text)
+    # batch up all phrases that need part-of-speech tagging so the
+    # tagger is only invoked once, instead of once per phrase
+    long_phrases = [
+        phrase
+        for token in default_tokens if len(token) > MAXCHARS
+        for phrase in token.split(':') if len(phrase) > MAXCHARS
+    ]
+    phrase_tags = {}
+    if long_phrases:
+        _load_models()
+        words_per_phrase = [
+            [word for sent in _sent_tokenizer.tokenize(phrase)
+                  for word in _word_tokenizer.tokenize(sent)]
+            for phrase in long_phrases
+        ]
+        tags_per_phrase = _tagger.tag_sents(words_per_phrase)
+        phrase_tags = dict(zip(long_phrases, tags_per_phrase))
     tokens = []
     for i,token in enumerate(default_tokens):
         if len(token) > MAXCHARS:
@@ -71,13 +164,11 @@ def MyTokenizer(text,debug=False):
                     tokens.append(phrase)
                     if debug: print(phrase)
                 else:
-                    # then split into words and tag with parts of speech
-                    words = nltk.word_tokenize(phrase)
-                    word_tags = nltk.pos_tag(words)
-                    # next, chunk what's left
-                    chunked = chunker.parse(word_tags)
-                    # group words to make sure key phrases don't get broken up
-                    consolidate(chunked)
+                    # then look up the words tagged with parts of speech
+                    word_tags = phrase_tags[phrase]
+                    # next, chunk what's left to group words and make
+                    # sure key phrases don't get broken up
+                    chunked = chunk(word_tags)
                     if debug:
                         for token_pos in chunked:
                             print(' ',token_pos)